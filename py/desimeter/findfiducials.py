@@ -8,17 +8,28 @@ from astropy.table import Column
 from scipy.spatial import cKDTree as KDTree
 from desimeter.io import load_metrology,fvc2fp_filename
 from desimeter.transform.fvc2fp import FVC2FP
-from desimeter.match import match_same_system,match_arbitrary_translation_dilatation
+from desimeter.match import match_same_system,match_arbitrary_translation_dilatation,precompute_triangles
+from desimeter.match import KDTree as NNKDTree # pykdtree if available, else scipy
 from desimeter.simplecorr import SimpleCorr
 
 metrology_pinholes_table = None
 metrology_fiducials_table = None
+metrology_pinholes_triangles = None
+# plain contiguous numpy arrays of the fiducials metrology, cached alongside
+# the table to avoid converting astropy columns at each call
+metrology_fiducials_xpix = None
+metrology_fiducials_ypix = None
+metrology_fiducials_location = None
 
 
 def findfiducials(spots,input_transform=None,pinhole_max_separation_mm=1.5) :
 
     global metrology_pinholes_table
     global metrology_fiducials_table
+    global metrology_pinholes_triangles
+    global metrology_fiducials_xpix
+    global metrology_fiducials_ypix
+    global metrology_fiducials_location
     log = get_logger()
 
     log.debug("load input tranformation we will use to go from FP to FVC pixels")
@@ -55,47 +66,80 @@ def findfiducials(spots,input_transform=None,pinhole_max_separation_mm=1.5) :
             k=np.argmin((metrology_pinholes_table["XPIX"][ii]-mx)**2+(metrology_pinholes_table["YPIX"][ii]-my)**2)
             central_pinholes.append(ii[k])
         metrology_fiducials_table = metrology_pinholes_table[:][central_pinholes]
+        metrology_fiducials_xpix = np.ascontiguousarray(metrology_fiducials_table["XPIX"],dtype=float)
+        metrology_fiducials_ypix = np.ascontiguousarray(metrology_fiducials_table["YPIX"],dtype=float)
+        metrology_fiducials_location = np.asarray(metrology_fiducials_table["LOCATION"],dtype=int)
+
+        log.debug("precompute the triangles of the pinhole pattern of each fiducial")
+        # the metrology is static so this is done only once for all exposures
+        metrology_pinholes_triangles = dict()
+        pinhole_location = np.asarray(metrology_pinholes_table["LOCATION"],dtype=int)
+        pinhole_xpix = np.ascontiguousarray(metrology_pinholes_table["XPIX"],dtype=float)
+        pinhole_ypix = np.ascontiguousarray(metrology_pinholes_table["YPIX"],dtype=float)
+        pinhole_id = np.asarray(metrology_pinholes_table["PINHOLE_ID"],dtype=int)
+        for loc in np.unique(pinhole_location) :
+            ii = np.where(pinhole_location==loc)[0]
+            x2 = pinhole_xpix[ii]
+            y2 = pinhole_ypix[ii]
+            metrology_pinholes_triangles[loc] = (ii,x2,y2,pinhole_id[ii],precompute_triangles(x2,y2))
 
     # find fiducials candidates
     log.info("select spots with at least two close neighbors (in pixel units)")
     nspots=spots["XPIX"].size
-    xy   = np.array([spots["XPIX"],spots["YPIX"]]).T
-    tree = KDTree(xy)
-
-    measured_spots_distances,measured_spots_indices = tree.query(xy,k=4,distance_upper_bound=pinhole_max_separation_pixels)
-    number_of_neighbors = np.sum( measured_spots_distances<pinhole_max_separation_pixels,axis=1)
+    # single contiguous (nspots,2) array reused for the tree and all
+    # coordinate reads below, instead of repeated column accesses
+    spots_xy = np.empty((nspots,2))
+    spots_xy[:,0] = spots["XPIX"]
+    spots_xy[:,1] = spots["YPIX"]
+    tree = KDTree(spots_xy)
+
+    # count the neighbors within the radius directly instead of sorting the
+    # 4 nearest per spot and comparing their distances
+    number_of_neighbors = tree.query_ball_point(spots_xy,r=pinhole_max_separation_pixels,return_length=True,workers=-1)
     fiducials_candidates_indices = np.where(number_of_neighbors>=4)[0]  # including self, so at least 3 pinholes
+    # lists of neighboring spots of each candidate, used for the pinhole match below
+    fiducials_candidates_neighbors = np.empty(fiducials_candidates_indices.size,dtype=object)
+    fiducials_candidates_neighbors[:] = tree.query_ball_point(spots_xy[fiducials_candidates_indices],r=pinhole_max_separation_pixels,workers=-1)
     log.debug("number of fiducials=",fiducials_candidates_indices.size)
 
     # match candidates to fiducials from metrology
     log.info("first match {} fiducials candidates to metrology ({}) with iterative fit".format(fiducials_candidates_indices.size,len(metrology_fiducials_table)))
-    x1 = spots["XPIX"][fiducials_candidates_indices]
-    y1 = spots["YPIX"][fiducials_candidates_indices]
-    x2 = metrology_fiducials_table["XPIX"]
-    y2 = metrology_fiducials_table["YPIX"]
+    # the refinement loop below only does fancy-index gathers on plain arrays
+    x1 = spots_xy[fiducials_candidates_indices,0]
+    y1 = spots_xy[fiducials_candidates_indices,1]
+    x2 = metrology_fiducials_xpix
+    y2 = metrology_fiducials_ypix
+
+    # build the tree of measured candidates once, the refinement loop moves
+    # the metrology points (the query side) so the tree never changes
+    candidates_xy = np.empty((x1.size,2))
+    candidates_xy[:,0] = x1
+    candidates_xy[:,1] = y1
+    candidates_tree = NNKDTree(candidates_xy)
 
     nloop=20
     saved_median_distance=0
     for loop in range(nloop) :
-        indices_2, distances = match_same_system(x1,y1,x2,y2)
-        mdist = np.median(distances[indices_2>=0])
+        indices_1, distances = match_same_system(x2,y2,x1,y1,tree2=candidates_tree)
+        mdist = np.median(distances[indices_1>=0])
         if loop < nloop-1 :
             maxdistance = max(10,3.*1.4*mdist)
         else : # final iteration
             maxdistance = 10 # pixel
-        selection = np.where((indices_2>=0)&(distances<maxdistance))[0]
+        selection = np.where((indices_1>=0)&(distances<maxdistance))[0]
         log.info("iter #{} median_dist={} max_dist={} matches={}".format(loop,mdist,maxdistance,selection.size))
         corr21 = SimpleCorr()
-        corr21.fit(x2[indices_2[selection]],y2[indices_2[selection]],x1[selection],y1[selection])
+        corr21.fit(x2[selection],y2[selection],x1[indices_1[selection]],y1[indices_1[selection]])
         x2,y2 = corr21.apply(x2,y2)
         if np.abs(saved_median_distance-mdist)<0.0001 : break # no more improvement
         saved_median_distance = mdist
 
-    # use same coord system match (note we now match the otherway around)
-    indices_1, distances = match_same_system(x2,y2,x1,y1)
+    # final match in same coord system, with the same tree
+    indices_1, distances = match_same_system(x2,y2,x1,y1,tree2=candidates_tree)
     maxdistance = 10. # FVC pixels
     selection = np.where((indices_1>=0)&(distances<maxdistance))[0]
     fiducials_candidates_indices     = fiducials_candidates_indices[indices_1[selection]]
+    fiducials_candidates_neighbors   = fiducials_candidates_neighbors[indices_1[selection]]
     matching_known_fiducials_indices = selection
 
     log.debug("mean distance = {:4.2f} pixels for {} matched and {} known fiducials".format(np.mean(distances[distances<maxdistance]),fiducials_candidates_indices.size,metrology_fiducials_table["XPIX"].size))
@@ -104,37 +148,31 @@ def findfiducials(spots,input_transform=None,pinhole_max_separation_mm=1.5) :
     log.debug("now matching pinholes ...")
 
     nspots=spots["XPIX"].size
-    for k in ['LOCATION','PETAL_LOC','DEVICE_LOC','PINHOLE_ID'] :
-        if k not in spots.dtype.names :
-            spots.add_column(Column(np.zeros(nspots,dtype=int)),name=k)
-    spots["LOCATION"][:]=-1
-    spots["PETAL_LOC"][:]=-1
-    spots["DEVICE_LOC"][:]=-1
-    spots["PINHOLE_ID"][:]=0
-
-    for index1,index2 in zip ( fiducials_candidates_indices , matching_known_fiducials_indices ) :
-        location = metrology_fiducials_table["LOCATION"][index2]
-
-        # get indices of all pinholes for this matched fiducial
-        # note we now use the full pinholes metrology table
-        pi1 = measured_spots_indices[index1][measured_spots_distances[index1]<pinhole_max_separation_pixels]
-        pi2 = np.where(metrology_pinholes_table["LOCATION"]==location)[0]
+    # accumulate the matches in plain numpy arrays and write each astropy
+    # column in one shot at the end, instead of scattering into the columns
+    # inside the loop over fiducials
+    location_array   = np.full(nspots,-1,dtype=int)
+    pinhole_id_array = np.zeros(nspots,dtype=int)
+
+    for pi1,index2 in zip ( fiducials_candidates_neighbors , matching_known_fiducials_indices ) :
+        location = metrology_fiducials_location[index2]
 
-        x1 = spots["XPIX"][pi1]
-        y1 = spots["YPIX"][pi1]
+        # indices of all pinholes for this matched fiducial
+        # note we now use the full pinholes metrology table
+        pi1 = np.asarray(pi1,dtype=int)
+        pi2,x2,y2,metrology_pinhole_ids,triangles2 = metrology_pinholes_triangles[location]
 
-        x2 = metrology_pinholes_table["XPIX"][pi2]
-        y2 = metrology_pinholes_table["YPIX"][pi2]
+        x1 = spots_xy[pi1,0]
+        y1 = spots_xy[pi1,1]
 
-        indices_2 , distances = match_arbitrary_translation_dilatation(x1,y1,x2,y2)
+        indices_2 , distances = match_arbitrary_translation_dilatation(x1,y1,x2,y2,triangles2=triangles2)
 
-        metrology_pinhole_ids = metrology_pinholes_table["PINHOLE_ID"][pi2]
         pinhole_ids = np.zeros(x1.size,dtype=int)
         matched=(indices_2>=0)
         pinhole_ids[matched] = metrology_pinhole_ids[indices_2[matched]]
 
-        spots["LOCATION"][pi1[matched]]   = location
-        spots["PINHOLE_ID"][pi1[matched]] = pinhole_ids[matched]
+        location_array[pi1[matched]]   = location
+        pinhole_id_array[pi1[matched]] = pinhole_ids[matched]
 
         if np.sum(pinhole_ids==0) > 0 :
             log.warning("only matched pinholes {} for {} detected at LOCATION {} xpix~{} ypix~{}".format(pinhole_ids[pinhole_ids>0],x1.size,location,int(np.mean(x1)),int(np.mean(y1))))
@@ -148,15 +186,22 @@ def findfiducials(spots,input_transform=None,pinhole_max_separation_mm=1.5) :
             duplicates = np.where(bc>1)[0]
             for duplicate in duplicates :
                 log.warning("Unmatch ambiguous pinhole id = {}".format(duplicate))
-                selection=(spots["LOCATION"]==location)&(spots["PINHOLE_ID"]==duplicate)
-                spots["PINHOLE_ID"][selection]=0
-
-    ii=(spots["LOCATION"]>=0)
-    spots["PETAL_LOC"][ii]=spots["LOCATION"][ii]//1000
-    spots["DEVICE_LOC"][ii]=spots["LOCATION"][ii]%1000
-
-    n_matched_pinholes  = np.sum(spots["PINHOLE_ID"]>0)
-    n_matched_fiducials = np.sum(spots["PINHOLE_ID"]==4)
+                selection=(location_array==location)&(pinhole_id_array==duplicate)
+                pinhole_id_array[selection]=0
+
+    petal_loc_array  = np.full(nspots,-1,dtype=int)
+    device_loc_array = np.full(nspots,-1,dtype=int)
+    ii=(location_array>=0)
+    petal_loc_array[ii]=location_array[ii]//1000
+    device_loc_array[ii]=location_array[ii]%1000
+
+    spots["LOCATION"]   = Column(location_array)
+    spots["PETAL_LOC"]  = Column(petal_loc_array)
+    spots["DEVICE_LOC"] = Column(device_loc_array)
+    spots["PINHOLE_ID"] = Column(pinhole_id_array)
+
+    n_matched_pinholes  = np.sum(pinhole_id_array>0)
+    n_matched_fiducials = np.sum(pinhole_id_array==4)
     log.info("matched {} pinholes from {} fiducials".format(n_matched_pinholes,n_matched_fiducials))
 
     return spots
@@ -3,10 +3,35 @@ Utility functions to match two catalogs of 2D coordinates
 """
 
 
+import itertools
+import math
+
 import numpy as np
-from scipy.spatial import cKDTree as KDTree
 from desimeter.log import get_logger
 
+try:
+    # pykdtree builds much faster than scipy's cKDTree on small 2D data and
+    # its query (internally multithreaded) is a drop-in for what we use here
+    from pykdtree.kdtree import KDTree
+    _kdtree_query_kwargs = {}
+except ModuleNotFoundError :
+    from scipy.spatial import cKDTree as KDTree
+    _kdtree_query_kwargs = {"workers" : -1}
+
+try:
+    from numba import njit
+    _have_numba = True
+except ModuleNotFoundError :
+    _have_numba = False
+
+# triangle sides are indexed following _triangle_side_pairs=[[0,1],[1,2],[0,2]]
+# _triangle_side_vertex[a,b] is the vertex connected to both side a and side b
+# (diagonal entries are meaningless and left at -1)
+_triangle_side_pairs = np.array([[0,1],[1,2],[0,2]])
+_triangle_side_vertex = np.full((3,3),-1,dtype=int)
+for _a,_b in itertools.permutations(range(3),2) :
+    _triangle_side_vertex[_a,_b] = np.intersect1d(_triangle_side_pairs[_a],_triangle_side_pairs[_b])[0]
+
 
 def compute_triangles_with_arbitrary_orientation(x,y) :
     """
@@ -14,50 +39,77 @@ def compute_triangles_with_arbitrary_orientation(x,y) :
      so it is independent of a possible rotation
     """
 
-    tk=[] # indices
-    tr=[] # max side length ratio
-    tc=[] # cosine of first vertex (after sorting according to side length)
-    ts=[] # orientation
-
-    nn=len(x)
-    for i in range(nn) :
-        for j in range(i+1,nn) :
-            for k in range(j+1,nn) :
-                # x y of vertices
-                ijk=np.array([i,j,k])
-                tx=x[ijk]
-                ty=y[ijk]
-
-                # sorting according to length (square)
-                # is not working well for our case because
-                # a lot of triangles are isosceles
-                tl2=np.array([(tx[1]-tx[0])**2+(ty[1]-ty[0])**2,(tx[2]-tx[1])**2+(ty[2]-ty[1])**2,(tx[0]-tx[2])**2+(ty[0]-ty[2])**2])
-                pairs=np.array([[0,1],[1,2],[0,2]])
-                ii=np.argsort(tl2)
-                ordering = np.zeros(3).astype(int)
-                ordering[0] = np.intersect1d(pairs[ii[0]],pairs[ii[2]]) # vertex connected to shortest and longest side
-                ordering[1] = np.intersect1d(pairs[ii[0]],pairs[ii[1]]) # vertex connected to shortest and intermediate side
-                ordering[2] = np.intersect1d(pairs[ii[1]],pairs[ii[2]]) # vertex connected to intermediate and longest side
-
-                ijk=ijk[ordering]
-                tx=tx[ordering]
-                ty=ty[ordering]
-
-                length2=np.array([(tx[1]-tx[0])**2+(ty[1]-ty[0])**2,(tx[2]-tx[1])**2+(ty[2]-ty[1])**2,(tx[0]-tx[2])**2+(ty[0]-ty[2])**2])
-                r=np.sqrt(np.max(length2)/np.min(length2)) # ratio of longest to shortest side
-
-                c=((tx[1]-tx[0])*(tx[2]-tx[0])+(ty[1]-ty[0])*(ty[2]-ty[0]))/np.sqrt( ((tx[1]-tx[0])**2+(ty[1]-ty[0])**2)*((tx[2]-tx[0])**2+(ty[2]-ty[0])**2)) # cos of angle of first vertex
-
-                s=((tx[1]-tx[0])*(ty[2]-ty[0])-(tx[2]-tx[0])*(ty[1]-ty[0]))/np.sqrt( ((tx[1]-tx[0])**2+(ty[1]-ty[0])**2)*((tx[2]-tx[0])**2+(ty[2]-ty[0])**2)) # orientation whether vertices are traversed in a clockwise or counterclock-wise sense
-
-
-                tk.append(ijk)
-                tr.append(r)
-                tc.append(c)
-                ts.append(s)
-    return np.array(tk),np.array(tr),np.array(tc),np.array(ts)
-
-
+    x = np.asarray(x)
+    y = np.asarray(y)
+    nn = len(x)
+
+    # all C(nn,3) triangles at once, one row of vertex indices per triangle
+    tk = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(nn),3)),int).reshape(-1,3)
+    ntri = tk.shape[0]
+    tx = x[tk] # (ntri,3)
+    ty = y[tk]
+
+    # sorting according to length (square)
+    # is not working well for our case because
+    # a lot of triangles are isosceles
+    # sides are indexed following pairs=[[0,1],[1,2],[0,2]]
+    tl2 = np.stack([(tx[:,1]-tx[:,0])**2+(ty[:,1]-ty[:,0])**2,
+                    (tx[:,2]-tx[:,1])**2+(ty[:,2]-ty[:,1])**2,
+                    (tx[:,0]-tx[:,2])**2+(ty[:,0]-ty[:,2])**2],axis=1)
+    ii=np.argsort(tl2,axis=1)
+    ordering = np.zeros((ntri,3),dtype=int)
+    ordering[:,0] = _triangle_side_vertex[ii[:,0],ii[:,2]] # vertex connected to shortest and longest side
+    ordering[:,1] = _triangle_side_vertex[ii[:,0],ii[:,1]] # vertex connected to shortest and intermediate side
+    ordering[:,2] = _triangle_side_vertex[ii[:,1],ii[:,2]] # vertex connected to intermediate and longest side
+
+    rows = np.arange(ntri)[:,None]
+    tk=tk[rows,ordering]
+    tx=tx[rows,ordering]
+    ty=ty[rows,ordering]
+
+    # side vectors and squared lengths of the reordered triangles
+    x01 = tx[:,1]-tx[:,0] ; y01 = ty[:,1]-ty[:,0]
+    x02 = tx[:,2]-tx[:,0] ; y02 = ty[:,2]-ty[:,0]
+    d01 = x01**2+y01**2
+    d12 = (tx[:,2]-tx[:,1])**2+(ty[:,2]-ty[:,1])**2
+    d02 = x02**2+y02**2
+    length2 = np.stack([d01,d12,d02],axis=1)
+
+    tr=np.sqrt(np.max(length2,axis=1)/np.min(length2,axis=1)) # ratio of longest to shortest side
+    norme=np.sqrt(d01*d02)
+    tc=(x01*x02+y01*y02)/norme # cos of angle of first vertex
+    ts=(x01*y02-x02*y01)/norme # orientation whether vertices are traversed in a clockwise or counterclock-wise sense
+
+    return tk,tr,tc,ts
+
+
+
+if _have_numba :
+    @njit(cache=True, fastmath=True)
+    def _compute_triangles_with_fixed_orientation_kernel(x,y,tk,txyz) :
+        '''Fill preallocated tk,txyz for points already sorted along x.
+        Same math as the pure python loop below, written with scalars so
+        numba compiles it to tight machine code without temporaries.'''
+        nn=x.size
+        triangle_index=0
+        for i in range(nn) :
+            for j in range(i+1,nn) :
+                for k in range(j+1,nn) :
+                    x01=x[j]-x[i] ; y01=y[j]-y[i]
+                    x12=x[k]-x[j] ; y12=y[k]-y[j]
+                    x02=x[k]-x[i] ; y02=y[k]-y[i]
+                    d01=x01*x01+y01*y01
+                    d12=x12*x12+y12*y12
+                    d02=x02*x02+y02*y02
+                    dmin=min(d01,min(d12,d02))
+                    dmax=max(d01,max(d12,d02))
+                    tk[triangle_index,0]=i
+                    tk[triangle_index,1]=j
+                    tk[triangle_index,2]=k
+                    txyz[triangle_index,0]=math.sqrt(dmax/dmin) # ratio of longest to shortest side
+                    txyz[triangle_index,1]=(x01*x02+y01*y02)/math.sqrt(d01*d02) # cos of angle of first vertex
+                    txyz[triangle_index,2]=x01/math.sqrt(d01) # cos of angle of first side
+                    triangle_index += 1
 
 def compute_triangles_with_fixed_orientation(x,y) :
     """
@@ -76,30 +128,63 @@ def compute_triangles_with_fixed_orientation(x,y) :
     ordering = np.argsort(x)
     x=x[ordering]
     y=y[ordering]
-    tx=np.zeros(3)
-    ty=np.zeros(3)
-
-    triangle_index=0
-    for i in range(nn) :
-        tx[0]=x[i]
-        ty[0]=y[i]
-        for j in range(i+1,nn) :
-            tx[1]=x[j]
-            ty[1]=y[j]
-            for k in range(j+1,nn) :
-                # x y of vertices
-                tx[2]=x[k]
-                ty[2]=y[k]
-                length2=np.array([(tx[1]-tx[0])**2+(ty[1]-ty[0])**2,(tx[2]-tx[1])**2+(ty[2]-ty[1])**2,(tx[0]-tx[2])**2+(ty[0]-ty[2])**2])
-                #r=np.sqrt(np.max(length2)/np.min(length2)) # ratio of longest to shortest side
-                tk[triangle_index]=ordering[[i,j,k]]
-                txyz[triangle_index,0]=np.sqrt(np.max(length2)/np.min(length2)) # ratio of longest to shortest side
-                txyz[triangle_index,1]=((tx[1]-tx[0])*(tx[2]-tx[0])+(ty[1]-ty[0])*(ty[2]-ty[0]))/np.sqrt( ((tx[1]-tx[0])**2+(ty[1]-ty[0])**2)*((tx[2]-tx[0])**2+(ty[2]-ty[0])**2)) # cos of angle of first vertex
-                txyz[triangle_index,2]=(tx[1]-tx[0])/np.sqrt((tx[1]-tx[0])**2+(ty[1]-ty[0])**2) # cos of angle of first side
-                triangle_index += 1
+
+    if _have_numba :
+        _compute_triangles_with_fixed_orientation_kernel(np.asarray(x,dtype=float),np.asarray(y,dtype=float),tk,txyz)
+        return ordering[tk],txyz
+
+    # numpy fallback: enumerate all vertex triples at once and compute the
+    # shape properties as batched operations, no per-triangle temporaries
+    # (combinations of sorted indices preserve the i<j<k loop order)
+    triples = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(nn),3)),int).reshape(-1,3)
+    tx = x[triples]
+    ty = y[triples]
+
+    x01 = tx[:,1]-tx[:,0] ; y01 = ty[:,1]-ty[:,0]
+    x02 = tx[:,2]-tx[:,0] ; y02 = ty[:,2]-ty[:,0]
+    d01 = x01**2+y01**2
+    d12 = (tx[:,2]-tx[:,1])**2+(ty[:,2]-ty[:,1])**2
+    d02 = x02**2+y02**2
+    length2 = np.stack([d01,d12,d02],axis=1)
+
+    tk = ordering[triples]
+    txyz[:,0] = np.sqrt(np.max(length2,axis=1)/np.min(length2,axis=1)) # ratio of longest to shortest side
+    txyz[:,1] = (x01*x02+y01*y02)/np.sqrt(d01*d02) # cos of angle of first vertex
+    txyz[:,2] = x01/np.sqrt(d01) # cos of angle of first side
     return tk,txyz
 
-def match_same_system(x1,y1,x2,y2,remove_duplicates=True) :
+# flat triangles have a poorly conditioned shape (a small displacement of a
+# vertex changes a lot the side length ratio), it's safer to not use them
+# for the match ; this is the max value of |cos| of the first vertex angle
+_max_cosine_of_flat_triangles = 0.99
+
+def _discard_flat_triangles(tk,txyz,npoints) :
+    '''Discard near-degenerate triangles, unless this would leave some of the
+    npoints vertices without any triangle (then keep everything).'''
+    keep = np.abs(txyz[:,1]) < _max_cosine_of_flat_triangles
+    if np.all(keep) :
+        return tk,txyz
+    if np.unique(tk[keep]).size < npoints :
+        return tk,txyz
+    return tk[keep],txyz[keep]
+
+def precompute_triangles(x,y) :
+    '''Precompute the triangles of a static catalog and the KDTree of their
+    shape parameters, to be passed as the triangles2 argument of
+    match_arbitrary_translation_dilatation when matching against the same
+    catalog many times.
+
+    Args:
+        x,y : float numpy arrays of coordinates
+
+    returns: tuple (tk,txyz,tree) with the outputs of
+        compute_triangles_with_fixed_orientation plus the KDTree of txyz
+    '''
+    tk,txyz = compute_triangles_with_fixed_orientation(x,y)
+    txyz = np.ascontiguousarray(txyz)
+    return tk,txyz,KDTree(txyz)
+
+def match_same_system(x1,y1,x2,y2,remove_duplicates=True,tree2=None) :
     """
     match two catalogs, assuming the coordinates are in the same coordinate system (no transfo)
     Args:
@@ -107,6 +192,9 @@ def match_same_system(x1,y1,x2,y2,remove_duplicates=True) :
         y1 : float numpy array of coordinates along second axis in same system
         x2 : float numpy array of coordinates along first axis in same system
         y2 : float numpy array of coordinates along second axis in same system
+        tree2 : optional, prebuilt KDTree (same class as desimeter.match.KDTree)
+                of the second catalog coordinates, to avoid rebuilding the tree
+                at each call
 
     returns:
         indices_2 : integer numpy array. if ii is a index array for entries in the first catalog,
@@ -116,10 +204,12 @@ def match_same_system(x1,y1,x2,y2,remove_duplicates=True) :
         distances : distances between pairs. It can be used to discard bad matches
 
     """
-    xy1=np.array([x1,y1]).T
-    xy2=np.array([x2,y2]).T
-    tree2 = KDTree(xy2)
-    distances,indices_2 = tree2.query(xy1,k=1)
+    xy1=np.ascontiguousarray(np.array([x1,y1],dtype=float).T)
+    if tree2 is None :
+        xy2=np.ascontiguousarray(np.array([x2,y2],dtype=float).T)
+        tree2 = KDTree(xy2)
+    distances,indices_2 = tree2.query(xy1,k=1,**_kdtree_query_kwargs)
+    indices_2 = np.asarray(indices_2,dtype=int) # pykdtree returns unsigned ints
 
     if remove_duplicates :
         unique_indices_2 = np.unique(indices_2)
@@ -134,7 +224,7 @@ def match_same_system(x1,y1,x2,y2,remove_duplicates=True) :
     distances[indices_2<0] = np.inf
     return indices_2,distances
 
-def match_arbitrary_translation_dilatation(x1,y1,x2,y2) :
+def match_arbitrary_translation_dilatation(x1,y1,x2,y2,discard_flat_triangles=False,triangles2=None) :
     """
     Match two catalogs in different coordinate systems, 1 and 2, related by a translation, a dilatation, and possibly a "small" rotation
     The orientation of triangles is used for the match so the rotation has to be small.
@@ -145,6 +235,16 @@ def match_arbitrary_translation_dilatation(x1,y1,x2,y2) :
         y1 : float numpy array of coordinates along second axis of cartesian coordinate system 1
         x2 : float numpy array of coordinates along first axis of cartesian coordinate system 2
         y2 : float numpy array of coordinates along second axis of cartesian coordinate system 2
+        discard_flat_triangles : optional, skip near-degenerate triangles of the
+              first catalog for the match. Do not use for the DESI pinhole
+              patterns where the nearly flat triangles carry information.
+        triangles2 : optional, precomputed triangles of the second catalog,
+              either the output (tk2,txyz2) of
+              compute_triangles_with_fixed_orientation(x2,y2), or preferably
+              the output (tk2,txyz2,tree2) of precompute_triangles(x2,y2)
+              which also avoids rebuilding the KDTree of the triangle shapes.
+              Useful when the second catalog is static and this routine is
+              called many times.
 
     returns:
         indices_2 : integer numpy array. if ii is a index array for entries in the first catalog,
@@ -161,12 +261,24 @@ def match_arbitrary_translation_dilatation(x1,y1,x2,y2) :
     # txyz are properties of the shape and orientation of the triangles
     log.debug("compute triangles")
     tk1,txyz1 = compute_triangles_with_fixed_orientation(x1,y1)
-    tk2,txyz2 = compute_triangles_with_fixed_orientation(x2,y2)
+    tree2 = None
+    if triangles2 is None :
+        tk2,txyz2 = compute_triangles_with_fixed_orientation(x2,y2)
+    elif len(triangles2) == 3 :
+        tk2,txyz2,tree2 = triangles2
+    else :
+        tk2,txyz2 = triangles2
+
+    if discard_flat_triangles :
+        # keep only well conditioned triangles on the query side
+        # (all triangles of the second catalog are kept as match targets)
+        tk1,txyz1 = _discard_flat_triangles(tk1,txyz1,x1.size)
 
     log.debug("match triangles")
     # match with kdtree triangles with same shape and orientation
-    tree2=KDTree(txyz2)
-    triangle_distances,triangle_indices_2 = tree2.query(txyz1,k=1)
+    if tree2 is None :
+        tree2=KDTree(np.ascontiguousarray(txyz2))
+    triangle_distances,triangle_indices_2 = tree2.query(np.ascontiguousarray(txyz1),k=1,**_kdtree_query_kwargs)
 
     # now that we have match of triangles , need to match back catalog entries
     ranked_pairs = np.argsort(triangle_distances)
@@ -174,23 +286,46 @@ def match_arbitrary_translation_dilatation(x1,y1,x2,y2) :
     indices_2 = -1*np.ones(x1.size,dtype=int)
     distances = np.zeros(x1.size)
 
-    all_matched = False
     log.debug("match catalogs using pairs of triangles")
-    for p in ranked_pairs :
-
-        k1=tk1[p] # incides (in x1,y1) of vertices of this triangle (size=3)
-        k2=tk2[triangle_indices_2[p]] # incides (in x2,y2) of vertices of other triangle
-
-        # check unmatched or equal
-        if np.any((indices_2[k1]>=0)&(indices_2[k1]!=k2)) :
-            log.warning("skip {} <=> {}".format(k1,k2))
-            continue
-        indices_2[k1]=k2
-        distances[k1]=triangle_distances[p]
-        all_matched = (np.sum(indices_2>=0)==x1.size)
-        if all_matched :
+
+    # fast path : each vertex is assigned from the best ranked triangle pair
+    # that contains it; this is what the sequential loop below does as long
+    # as no triangle pair is skipped because of a conflicting assignment
+    k1_flat = tk1[ranked_pairs].ravel() # vertex indices in rank order
+    k2_flat = tk2[triangle_indices_2[ranked_pairs]].ravel()
+    d_flat  = np.repeat(triangle_distances[ranked_pairs],3)
+    unique_k1,first_flat_index = np.unique(k1_flat,return_index=True)
+    if unique_k1.size == x1.size :
+        # the loop would stop at the pair where all vertices get matched
+        nflat = 3*(np.max(first_flat_index)//3+1)
+    else :
+        nflat = k1_flat.size
+    candidate_indices_2 = indices_2.copy()
+    candidate_indices_2[unique_k1] = k2_flat[first_flat_index]
+    if np.all(candidate_indices_2[k1_flat[:nflat]] == k2_flat[:nflat]) :
+        # no conflict among the processed pairs, scatter once
+        # (for duplicate vertex indices the last write wins, as in the loop)
+        indices_2 = candidate_indices_2
+        distances[k1_flat[:nflat]] = d_flat[:nflat]
+        if unique_k1.size == x1.size :
             log.debug("all matched")
-            break
+    else :
+        all_matched = False
+        for p in ranked_pairs :
+
+            k1=tk1[p] # incides (in x1,y1) of vertices of this triangle (size=3)
+            k2=tk2[triangle_indices_2[p]] # incides (in x2,y2) of vertices of other triangle
+
+            # check unmatched or equal
+            if np.any((indices_2[k1]>=0)&(indices_2[k1]!=k2)) :
+                log.warning("skip {} <=> {}".format(k1,k2))
+                continue
+            indices_2[k1]=k2
+            distances[k1]=triangle_distances[p]
+            all_matched = (np.sum(indices_2>=0)==x1.size)
+            if all_matched :
+                log.debug("all matched")
+                break
 
     # check duplicates
     for i2 in np.unique(indices_2[indices_2>=0]) :
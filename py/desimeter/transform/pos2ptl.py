@@ -70,29 +70,79 @@ for instrument control, only for target selection or analyis purposes. Therefore
 angular range limits are NOT implemented here.
 """
 
+import math
+
 import numpy as np
 import desimeter.transform.xy2qs as xy2qs
 import desimeter.transform.xy2tp as xy2tp
 
+try:
+    import numba
+    _have_numba = True
+except ModuleNotFoundError:
+    _have_numba = False
+
 _default_t_int_range = [-180. + xy2tp.epsilon, 180.] # theta min, max
 _default_p_int_range = [-20., 200.] # phi min, max
 
+if _have_numba:
+    @numba.njit(cache=True, fastmath=True)
+    def _polar_to_cartesian_kernel(s, q, x, y):
+        for i in range(s.size):
+            x[i] = s[i] * math.cos(q[i])
+            y[i] = s[i] * math.sin(q[i])
+
+    @numba.njit(cache=True, fastmath=True)
+    def _ext2loc_kernel(t_ext, p_ext, r1, r2, x, y):
+        for i in range(t_ext.size):
+            t = math.radians(t_ext[i])
+            t_plus_p = t + math.radians(p_ext[i])
+            x[i] = r1[i] * math.cos(t) + r2[i] * math.cos(t_plus_p)
+            y[i] = r1[i] * math.sin(t) + r2[i] * math.sin(t_plus_p)
+
+def _cartesian_to_polar(x, y):
+    '''Internal function returning (arctan2(y,x), sqrt(x**2+y**2)).
+
+    For 1D arrays the pair is computed through a complex view: np.angle and
+    np.abs on complex128 are measurably faster here than separate np.arctan2
+    and np.hypot calls on the two real arrays.
+    '''
+    if np.ndim(x) == 1 and np.shape(x) == np.shape(y):
+        z = np.empty(np.size(x), np.complex128)
+        z.real = x
+        z.imag = y
+        return np.angle(z), np.abs(z)
+    return np.arctan2(y, x), np.hypot(x, y)
+
+def _polar_to_cartesian(s, q):
+    '''Internal function returning (s*cos(q), s*sin(q)).
+
+    With numba, cos and sin of each angle are computed in a single pass over
+    the array (the compiler emits one sincos call per element) instead of two
+    separate transcendental passes.
+    '''
+    if _have_numba and np.ndim(q) == 1:
+        s_arr = np.ascontiguousarray(s, dtype=np.float64)
+        q_arr = np.ascontiguousarray(q, dtype=np.float64)
+        if s_arr.shape == q_arr.shape:
+            x = np.empty(q_arr.size)
+            y = np.empty(q_arr.size)
+            _polar_to_cartesian_kernel(s_arr, q_arr, x, y)
+            return x, y
+    return s * np.cos(q), s * np.sin(q)
+
 def ptl2flat(x_ptl, y_ptl):
     '''Converts (x_ptl, y_ptl) coordinates to (x_ptl, y_ptl).'''
-    q = np.arctan2(y_ptl, x_ptl)
-    r = np.hypot(x_ptl, y_ptl)
+    q, r = _cartesian_to_polar(x_ptl, y_ptl)
     s = xy2qs.r2s(r)
-    x_flat = s * np.cos(q)
-    y_flat = s * np.sin(q)
+    x_flat, y_flat = _polar_to_cartesian(s, q)
     return x_flat, y_flat
 
 def flat2ptl(x_flat, y_flat):
     '''Converts (x_flat, y_flat) coordinates to (x_ptl, y_ptl).'''
-    q = np.arctan2(y_flat, x_flat)
-    s = np.hypot(x_flat, y_flat)
+    q, s = _cartesian_to_polar(x_flat, y_flat)
     r = xy2qs.s2r(s)
-    x_ptl = r * np.cos(q)
-    y_ptl = r * np.sin(q)
+    x_ptl, y_ptl = _polar_to_cartesian(r, q)
     return x_ptl, y_ptl
 
 def flat2loc(u_flat, u_offset):
@@ -155,43 +205,99 @@ def loc2ext(x_loc, y_loc, r1, r2, t_offset, p_offset,
     a few um from the edge of reachability. In these cases, near-enough can
     still deliver good spectra.)
     '''
-    x_loc = _to_list(x_loc)
-    y_loc = _to_list(y_loc)
-    r1 = _to_list(r1)
-    r2 = _to_list(r2)
-    t_offset = _to_list(t_offset)
-    p_offset = _to_list(p_offset)
-    t_guess = _to_list(t_ext_guess)
-    t_guess_tol = _to_list(t_guess_tol)
-    n = len(x_loc)
-    r1 = _extend_list(r1, n)
-    r2 = _extend_list(r2, n)
-    t_offset = _extend_list(t_offset, n)
-    p_offset = _extend_list(p_offset, n)
-    t_guess = _extend_list(t_guess, n)
-    t_guess_tol = _extend_list(t_guess_tol, n)
-    t_ext = []
-    p_ext = []
-    unreachable = []
+    x_loc = _to_numpy(x_loc)
+    y_loc = _to_numpy(y_loc)
+    r1 = _to_numpy(r1)
+    r2 = _to_numpy(r2)
+    t_offset = _to_numpy(t_offset)
+    p_offset = _to_numpy(p_offset)
+    if t_ext_guess is None:
+        return _loc2ext_vectorized(x_loc, y_loc, r1, r2, t_offset, p_offset)
+    n = x_loc.size
+    r1 = _extend_array(r1, n)
+    r2 = _extend_array(r2, n)
+    t_offset = _extend_array(t_offset, n)
+    p_offset = _extend_array(p_offset, n)
+    t_guess = _extend_array(t_ext_guess, n)
+    t_guess_tol = _extend_array(t_guess_tol, n)
+    t_ext = np.zeros(n)
+    p_ext = np.zeros(n)
+    unreachable = np.zeros(n, dtype=bool)
     for i in range(n):
-        ext_ranges = [[float(int2ext(_default_t_int_range[0], t_offset[i])),
-                       float(int2ext(_default_t_int_range[1], t_offset[i]))],
-                      [float(int2ext(_default_p_int_range[0], p_offset[i])),
-                       float(int2ext(_default_p_int_range[1], p_offset[i]))]]
-        tp_ext, unreach = xy2tp.xy2tp(xy=[x_loc[i], y_loc[i]],
-                                     r=[r1[i], r2[i]],
+        to = float(t_offset[i])
+        po = float(p_offset[i])
+        ext_ranges = [[_default_t_int_range[0] + to, _default_t_int_range[1] + to],
+                      [_default_p_int_range[0] + po, _default_p_int_range[1] + po]]
+        tp_ext, unreach = xy2tp.xy2tp(xy=[float(x_loc[i]), float(y_loc[i])],
+                                     r=[float(r1[i]), float(r2[i])],
                                      ranges=ext_ranges,
-                                     t_guess=t_guess[i],
-                                     t_guess_tol=t_guess_tol[i],
+                                     t_guess=float(t_guess[i]),
+                                     t_guess_tol=float(t_guess_tol[i]),
                                      )
-        t_ext.append(tp_ext[0])
-        p_ext.append(tp_ext[1])
-        unreachable.append(unreach)
-    t_ext = _to_numpy(t_ext)
-    p_ext = _to_numpy(p_ext)
-    unreachable = _to_numpy(unreachable)
+        t_ext[i] = tp_ext[0]
+        p_ext[i] = tp_ext[1]
+        unreachable[i] = unreach
+    return t_ext, p_ext, unreachable
+
+def _loc2ext_vectorized(x_loc, y_loc, r1, r2, t_offset, p_offset):
+    '''Vectorized equivalent of the xy2tp.xy2tp() primary configuration (i.e.
+    without theta guess), for whole arrays of positioners at once. Same math,
+    same numeric contractions, same range wrapping, but numpy ufuncs instead
+    of a python loop over points.
+
+    INPUTS and OUTPUTS: same as loc2ext() without the guess arguments.
+    '''
+    numeric_contraction = xy2tp.epsilon*10 # slight contraction to avoid numeric divide-by-zero type of errors
+
+    # adjust targets within reachable annulus
+    # (equivalent to testing |cos(phi)| > 1 in the law of cosines below, but
+    # clipping the radius rather than the cosine keeps the "nearest reachable"
+    # point identical to the contracted-annulus behavior of xy2tp.xy2tp)
+    hypot = (x_loc**2.0 + y_loc**2.0)**0.5
+    angle = np.arctan2(y_loc, x_loc)
+    outer = r1 + r2
+    inner = np.abs(r1 - r2)
+    unreachable = (hypot > outer) | (hypot < inner)
+    HYPOT = np.clip(hypot, inner + numeric_contraction, outer - numeric_contraction)
+    X = HYPOT*np.cos(angle)
+    Y = HYPOT*np.sin(angle)
+
+    # transform from cartesian XY to angles TP
+    arccos_arg = (X**2 + Y**2 - (r1**2 + r2**2)) / (2.0 * r1 * r2)
+    # deal with slight numeric errors where arccos_arg comes back like +/-1.0000000000000002
+    arccos_arg = np.clip(arccos_arg, -1.0, +1.0)
+    P = np.arccos(arccos_arg)
+    T = angle - np.arctan2(r2*np.sin(P), r1 + r2*np.cos(P))
+
+    t_ext, t_fail = _wrap_angle_into_range(np.degrees(T),
+                                           int2ext(_default_t_int_range[0], t_offset),
+                                           int2ext(_default_t_int_range[1], t_offset))
+    p_ext, p_fail = _wrap_angle_into_range(np.degrees(P),
+                                           int2ext(_default_p_int_range[0], p_offset),
+                                           int2ext(_default_p_int_range[1], p_offset))
+    unreachable = unreachable | t_fail | p_fail
     return t_ext, p_ext, unreachable
 
+def _wrap_angle_into_range(angle, range_min, range_max):
+    '''Vectorized equivalent of xy2tp._wrap_into_range(): check +/-360 deg
+    phase wraps (as necessary) to put angles within the argued ranges, and
+    clamp to the range limit (flagged unreachable) when no wrap fits.
+
+    INPUT:  angle ... numpy array of values to be checked, units deg
+            range_min, range_max ... lowest / highest allowed, scalar or array
+
+    OUTPUT: new ... new angles
+            unreachable ... boolean array, True where angle cannot be put in range
+    '''
+    angle, range_min, range_max = np.broadcast_arrays(angle, range_min, range_max)
+    new = angle.astype(float)
+    too_low = angle < range_min
+    too_high = angle > range_max
+    new[too_low] += np.floor((range_max[too_low] - new[too_low])/360.0)*360.0
+    new[too_high] -= np.floor((new[too_high] - range_min[too_high])/360.0)*360.0
+    clamped = np.clip(new, range_min, range_max)
+    return clamped, clamped != new
+
 def ext2loc(t_ext, p_ext, r1, r2):
     '''Converts (t_ext, p_ext) coordinates to (x_loc, y_loc).
 
@@ -202,6 +308,18 @@ def ext2loc(t_ext, p_ext, r1, r2):
     OUTPUTS:
         x_loc, y_loc ... positioner local (x,y), as described in module notes
     '''
+    if _have_numba and np.ndim(t_ext) == 1:
+        t_arr = np.ascontiguousarray(t_ext, dtype=np.float64)
+        p_arr = np.ascontiguousarray(p_ext, dtype=np.float64)
+        if t_arr.shape == p_arr.shape:
+            # single pass over memory, no intermediate arrays, fused sincos
+            n = t_arr.size
+            r1_arr = np.ascontiguousarray(_extend_array(r1, n), dtype=np.float64)
+            r2_arr = np.ascontiguousarray(_extend_array(r2, n), dtype=np.float64)
+            x_loc = np.empty(n)
+            y_loc = np.empty(n)
+            _ext2loc_kernel(t_arr, p_arr, r1_arr, r2_arr, x_loc, y_loc)
+            return x_loc, y_loc
     t = np.radians(t_ext)
     t_plus_p = t + np.radians(p_ext)
     r1 = _to_numpy(r1)
@@ -356,26 +474,9 @@ def ptl2int(x_ptl, y_ptl, r1, r2, t_offset, p_offset, x_offset, y_offset,
     return t_int, p_int, unreachable
 
 def _to_numpy(u):
-    '''Internal function to cast values to consistent numpy vectors.'''
-    if isinstance(u, list):
-        return np.array(u)
-    if np.size(u) == 1:
-        return np.array([float(u)])
-    if isinstance(u, np.ndarray):
-        return u
-    return np.array(u)
-
-def _to_list(u):
-    '''Internal function to cast values to consistent python list vectors.'''
-    if isinstance(u, list):
-        return u
-    if np.size(u) == 1:
-        if u == None:
-            return [None]
-        return [float(u)]
-    if isinstance(u, np.ndarray):
-        return u.tolist()
-    return np.array(u).tolist()
+    '''Internal function to cast values to consistent numpy vectors.
+    Scalars and lists become 1d arrays, arrays are passed through uncopied.'''
+    return np.atleast_1d(np.asarray(u))
 
 def _add_offset(u, offset):
     '''Internal function to apply arithmetic offsets consistently to vectors.'''
@@ -383,8 +484,9 @@ def _add_offset(u, offset):
     offset = _to_numpy(offset)
     return u + offset
 
-def _extend_list(L, n):
-    '''Extend list L to length n, copying values as necessary.'''
-    if len(L) != n:
-        L = [L[0]]*n
-    return L
+def _extend_array(u, n):
+    '''Extend array u to size n, copying values as necessary.'''
+    u = _to_numpy(u)
+    if u.size != n:
+        u = np.full(n, u[0])
+    return u